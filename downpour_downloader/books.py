@@ -18,23 +18,36 @@ along with this program.  If not, see [https://www.gnu.org/licenses/].
 import os
 import re
 import json
+import threading
+from queue import Queue
 from textwrap import shorten
-from datetime import datetime, date
+from operator import itemgetter
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
 from tqdm import tqdm
 from dateutil import parser
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests import RequestException
 from tabulate import tabulate, tabulate_formats
 
 from sqlalchemy.sql import or_
 from sqlalchemy_utils.types import URLType
-from sqlalchemy import (Table, Column, Date, DateTime, Integer, String,
-                        Boolean, Float, func)
+from sqlalchemy import (Table, Column, Index, Date, DateTime, Integer,
+                        String, Boolean, Float, func)
 
 from .content import DownpourContent
 
+# Matches the part number in a manifest entry's "File X of Y" label
+_FILE_PART_RE = re.compile(r'^File (\d+) of \d+$', re.I)
+
+# Only parse the book links out of the library page, matching the class
+# even when the span carries other classes too
+_LIBRARY_BOOKS = SoupStrainer('span', attrs={
+    'class': lambda c: c and 'product-library-item-link' in c.split()
+})
+
 
 class BooksContent(DownpourContent):
     """Manage Downpour books."""
@@ -47,13 +60,15 @@ class BooksContent(DownpourContent):
     # Set CLI details for videos
     command_help = 'Manage Downpour books.'
     commands = ['list', 'update', 'show', 'download', 'open']
+    # Maximum number of book files to download at once
+    download_workers = 4
+    # Size of chunks to read from file download streams
+    download_chunk_size = 1 << 20
 
     def _update_books(self, session):
         """Add new books to database."""
-        res = requests.get(self.library_url,
-                           headers=self.headers,
-                           cookies=session)
-        soup = BeautifulSoup(res.text, self.parser)
+        res = self.session(session).get(self.library_url)
+        soup = BeautifulSoup(res.text, self.parser, parse_only=_LIBRARY_BOOKS)
 
         # Find book data
         all_books = soup.find_all('span', attrs={
@@ -68,16 +83,20 @@ class BooksContent(DownpourContent):
             'bar_format': '{l_bar}{bar}| {n_fmt}/{total_fmt} {unit}'
         }
 
+        # Load the IDs of all books already in the database
+        known_ids = {row.book_id for row in self.db.query(self.model.book_id)}
+
         # Parse list of books
         added = []
         for dp_book in tqdm(**progress_bar):
-            book = self._create_book(dp_book)
+            book = self._create_book(dp_book, known_ids)
             if book:
+                known_ids.add(book.book_id)
                 added.append(book)
-                self.db.add(book)
 
-        # Only commit the changes if anything was added
+        # Only save the changes if anything was added
         if added:
+            self.db.bulk_save_objects(added)
             self.db.commit()
 
         # Return the list of added books
@@ -89,14 +108,21 @@ class BooksContent(DownpourContent):
             .filter_by(book_id=book_id)\
             .one_or_none()
 
-    def _create_book(self, book):
+    def _find_books(self, book_ids):
+        """Searches for multiple books in the database by ID."""
+        books = self.db.query(self.model)\
+            .filter(self.model.book_id.in_(book_ids))\
+            .all()
+        return {book.book_id: book for book in books}
+
+    def _create_book(self, book, known_ids):
         """Creates a new video entry in the database."""
         attrs = book.attrs
         book_id = attrs['data-book_id']
         runtime = attrs['data-runtime']
 
         # Check for existing
-        if self._find_book(book_id):
+        if book_id in known_ids:
             return None
 
         # Setup dates
@@ -130,26 +156,26 @@ class BooksContent(DownpourContent):
         # Get JSON
         dl_json = dl_data.json()
         if not dl_json['status']:
-            self.manager.error('Could not retrieve book download manifest')
+            self.manager.error(f'Could not retrieve book download manifest '
+                               f'for: {book.title}')
             return None
 
         # Get manifest
         manifest = dl_json['manifest']
 
-        # Set up file regexes
-        file_regex = fr'\.{file_type}$'
-        file_part_regex = r'^File (\d+) of \d+$'
+        # Set up file extension
+        file_ext = f'.{file_type.lower()}'
 
         # Return only correct file type
         files = []
-        for file_name in manifest.keys():
-            if re.search(file_regex, file_name, re.I):
-                file = manifest[file_name]
-
+        for file_name, file in manifest.items():
+            if file_name.lower().endswith(file_ext):
                 # Parse file part number
-                part = re.match(file_part_regex, file['countOf'], re.I)
+                part = _FILE_PART_RE.match(file['countOf'])
                 if not part:
-                    self.manager.error('Could not parse book download part')
+                    self.manager.error(f'Could not parse book download part '
+                                       f'for: {book.title}')
+                    return None
 
                 # Set file part number
                 file['part'] = int(part.group(1))
@@ -158,17 +184,15 @@ class BooksContent(DownpourContent):
                 files.append(file)
 
         # Sort files by part number
-        sorted_files = sorted(files, key=lambda k: k['part'], reverse=False)
+        files.sort(key=itemgetter('part'))
 
         # Return sorted file list
-        return sorted_files
+        return files
 
     def _get_download_url(self, session, file_info):
         """Retrieve Downpour book file download URL."""
-        dl_url = requests.post(
+        dl_url = self.session(session).post(
             self.book_dl_url,
-            headers=self.headers,
-            cookies=session,
             data={
                 'bdfile': file_info['filename'],
                 'niceName': file_info['prettyName']
@@ -191,7 +215,7 @@ class BooksContent(DownpourContent):
         # Set up folder name from book author and title
         book_folder = account.folder_template.format(
             title=book.title,
-            author=', '.join(book.author.split('|')),
+            author=book.author.replace('|', ', '),
             book_id=book.book_id
         )
 
@@ -199,8 +223,7 @@ class BooksContent(DownpourContent):
         book_path = os.path.join(download_dir, book_folder)
 
         # Create folders if they don't exist
-        if not os.path.exists(book_path):
-            os.makedirs(book_path)
+        os.makedirs(book_path, exist_ok=True)
 
         # Return
         return book_path
@@ -212,93 +235,191 @@ class BooksContent(DownpourContent):
             return False
 
         # Check that directory is readable and writable
-        if not os.access(folder, os.W_OK or os.R_OK):
+        if not os.access(folder, os.R_OK | os.W_OK):
             self.manager.error(f'Unable read/write folder: {folder}')
             return False
 
         # Folder has correct permissions
         return True
 
-    def _download_book_file(self, account, file_data, file_path):
+    def _download_book_file(self, account, file_data, file_path, position=0,
+                            stop=None):
         """Download book part file from Downpour and rename it."""
         if os.path.isfile(file_path):
             self.manager.warning(f'File "{file_path}" exists, skipping')
             return
 
-        # Get download URL
-        file_url = self._get_download_url(account.session, file_data)
-
-        # Get target folder
-        out_folder = os.path.dirname(file_path)
-
-        # Check folder permissions
-        if not self._check_folder_permissions(out_folder):
+        # Download to a temporary file until the transfer is complete
+        part_path = f'{file_path}.part'
+
+        # Resume from the end of any previously interrupted download
+        resume_from = os.path.getsize(part_path) \
+            if os.path.isfile(part_path) else 0
+        headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+
+        # Get download URL and open file download stream
+        try:
+            file_url = self._get_download_url(account.session, file_data)
+            stream = self.session(account.session).get(
+                file_url, stream=True, headers=headers)
+        except RequestException as ex:
+            self.manager.error(f'Unable to download file: {str(ex)}')
             return
 
-        # Open file download stream
-        stream = self.session(account.session).get(file_url, stream=True)
-
-        # Setup download progress bar data
-        progress_bar = {
-            'miniters': 1,
-            'desc': os.path.basename(file_path),
-            'total': int(stream.headers.get('content-length', 0))
-        }
+        with stream:
+            try:
+                stream.raise_for_status()
+            except RequestException as ex:
+                if stream.status_code == 416 and resume_from:
+                    # The partial file may already hold the whole download
+                    content_range = stream.headers.get('content-range', '')
+                    if content_range.rpartition('/')[2] == str(resume_from):
+                        os.replace(part_path, file_path)
+                        return
+                    # Start over next time if it can't be resumed
+                    if os.path.isfile(part_path):
+                        os.remove(part_path)
+                self.manager.error(f'Unable to download file: {str(ex)}')
+                return
 
-        # Read and download from file stream
-        with tqdm.wrapattr(open(file_path, 'wb'), 'write', **progress_bar) as fh:
-            for chunk in stream.iter_content(chunk_size=4096):
-                fh.write(chunk)
+            # Start over if the server ignored the range request
+            if stream.status_code != 206:
+                resume_from = 0
+
+            # Expected size of the finished file, if the server reports it
+            # (Content-Length counts encoded bytes for compressed responses)
+            content_length = stream.headers.get('content-length')
+            total = resume_from + int(content_length) \
+                if content_length and \
+                'content-encoding' not in stream.headers else None
+
+            # Setup download progress bar data
+            progress_bar = {
+                'mininterval': 0.5,
+                'position': position,
+                'desc': os.path.basename(file_path),
+                'initial': resume_from,
+                'total': total
+            }
 
-        # Check that the file was downloaded
-        if not os.path.isfile(file_path):
-            self.manager.error(f'Unable to download file: {file_path}')
+            # Read and download from file stream
+            mode = 'ab' if resume_from else 'wb'
+            size = resume_from
+            try:
+                with tqdm.wrapattr(open(part_path, mode), 'write',
+                                   **progress_bar) as fh:
+                    for chunk in stream.iter_content(self.download_chunk_size):
+                        # Leave the partial file in place to resume later
+                        if stop is not None and stop.is_set():
+                            return
+                        fh.write(chunk)
+                        size += len(chunk)
+            except RequestException as ex:
+                self.manager.error(f'Download interrupted, run again to '
+                                   f'resume: {str(ex)}')
+                return
 
-    def _download_book(self, account, book, book_path, yes, file_type=None):
-        """Downloads book files to the specified path."""
-        file_type = file_type if file_type else account.file_type.value
+        # Keep the partial file if the connection closed early
+        if total is not None and size != total:
+            self.manager.error(f'Download incomplete ({size} of {total} '
+                               f'bytes), run again to resume: {file_path}')
+            return
 
-        # Get book file data from API
-        book_file_data = self._get_book_file_data(account, book, file_type)
+        # Move the finished file into place
+        os.replace(part_path, file_path)
+
+    def _download_in_slot(self, slots, account, file_data, file_path, stop):
+        """Download a book file using a free progress bar position."""
+        position = slots.get()
+        try:
+            self._download_book_file(account, file_data, file_path,
+                                     position, stop)
+        finally:
+            slots.put(position)
+
+    def _get_books_file_data(self, account, books, file_type, jobs=None):
+        """Get meta data for the files of several books concurrently."""
+        with ThreadPoolExecutor(max_workers=jobs or self.download_workers) \
+                as executor:
+            return list(executor.map(
+                lambda book: self._get_book_file_data(
+                    account, book, file_type),
+                books
+            ))
+
+    def _get_book_downloads(self, account, book, book_file_data, book_path,
+                            yes, file_type):
+        """Gets the book files to download and their target paths."""
+        # The file data lookup has already reported why it failed
+        if book_file_data is None:
+            return []
         if not book_file_data:
-            self.manager.error(f'No .{file_type} files found for this book.')
-            return
+            self.manager.error(f'No .{file_type} files found for: '
+                               f'{book.title}')
+            return []
 
         # Count how many book parts
         parts = len(book_file_data)
-        files = 'files' if parts > 1 else 'file'
+        multi_part = parts > 1
+        files = 'files' if multi_part else 'file'
 
         # Get path to download folder
         book_path = self._get_book_path(account, book, book_path)
+        if not self._check_folder_permissions(book_path):
+            return []
+
+        # Confirm the download
         if not yes:
             if not click.confirm(f'Download {parts} {files} to {book_path}?'):
-                return
+                return []
         else:
             click.echo(f'Downloading {parts} {files} to {book_path}')
 
-        # Download each book part
+        # Set up the file path for each book part
+        downloads = []
         for file_data in book_file_data:
             # Get file part number
             part = file_data['part']
 
             # Get file part
-            file_part = f', Part {part}' if parts > 1 else ''
+            file_part = f', Part {part}' if multi_part else ''
 
             # Get file name
-            file_name = '{book_title}{file_part}.{file_type}'.format(
-                book_title=file_data['title'],
-                file_part=file_part,
-                file_type=file_data['ext']
-            )
+            file_name = f"{file_data['title']}{file_part}.{file_data['ext']}"
 
             # Set file path
             file_path = os.path.join(book_path, file_name)
-
-            # Download the file
-            self._download_book_file(account, file_data, file_path)
-
-        # Finish download
-        click.echo('')
+            downloads.append((file_data, file_path))
+
+        # Return the list of files to download
+        return downloads
+
+    def _download_files(self, account, downloads, jobs=None):
+        """Downloads a list of book files in parallel."""
+        workers = min(jobs or self.download_workers, len(downloads))
+        # Signals running downloads to stop when the user interrupts
+        stop = threading.Event()
+        # One progress bar position per worker, reused as downloads finish
+        slots = Queue()
+        for position in range(workers):
+            slots.put(position)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._download_in_slot, slots, account,
+                                file_data, file_path, stop)
+                for file_data, file_path in downloads
+            ]
+            # Wait for all downloads to finish and surface any errors
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                # Drop queued downloads and stop the running ones
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                self.manager.warning('Download stopped, run again to resume')
+                raise
 
     @staticmethod
     def table(metadata):
@@ -321,6 +442,7 @@ class BooksContent(DownpourContent):
             Column('cover', URLType, nullable=False),
             Column('last_updated', DateTime, server_default=func.now(),
                    onupdate=func.now(), nullable=False),
+            Index('ix_books_purchase_date', 'purchase_date'),
         )
 
     @staticmethod
@@ -330,7 +452,7 @@ class BooksContent(DownpourContent):
         table_data = [[
             book.book_id,
             shorten(book.title, width=50),
-            shorten(', '.join(book.author.split('|')), width=50),
+            shorten(book.author.replace('|', ', '), width=50),
             f'{book.runtime} hr',
             book.purchase_date.strftime('%d %b %y')
         ] for book in books]
@@ -339,17 +461,14 @@ class BooksContent(DownpourContent):
     @staticmethod
     def format_json_book_list(books):
         """Create a JSON-formatted list of books."""
-        json_books = []
-        for book in books:
-            json_book = {}
-            for column in book.__table__.columns:
-                value = getattr(book, column.name)
-                if isinstance(value, datetime) or isinstance(value, date):
-                    json_book[column.name] = value.isoformat()
-                    continue
-                json_book[column.name] = value
-            json_books.append(json_book)
-        return json.dumps(json_books)
+        json_books = [{
+            column.name: getattr(book, column.name)
+            for column in book.__table__.columns
+        } for book in books]
+        # Convert dates and any other non-JSON values to strings
+        return json.dumps(json_books, default=lambda value: (
+            value.isoformat() if isinstance(value, date) else str(value)
+        ))
 
     def get_book(self, book_id):
         """Get book in database by ID."""
@@ -359,6 +478,18 @@ class BooksContent(DownpourContent):
             return None
         return book
 
+    def get_books(self, book_ids):
+        """Get books in database by IDs, in the order they were given."""
+        found = self._find_books(book_ids)
+        books = []
+        # Skip any IDs that were given more than once
+        for book_id in dict.fromkeys(book_ids):
+            if book_id not in found:
+                self.manager.error(f'No book found for ID: {book_id}')
+                continue
+            books.append(found[book_id])
+        return books
+
     @property
     def update(self):
         """Command to update the database with new books."""
@@ -388,16 +519,29 @@ class BooksContent(DownpourContent):
         @click.option('-d', '--dest', type=click.Path(exists=True),
                       help='Folder to download file(s) to.')
         @click.option('-f', '--file_type',
-                      type=click.Choice([b.value for b in self.file_types]),
+                      type=click.Choice(self.file_type_values),
                       help='Set book file type to download.')
+        @click.option('-j', '--jobs', default=self.download_workers,
+                      type=click.IntRange(min=1), show_default=True,
+                      help='Number of files to download at once.')
         @click.argument('book_ids', metavar='BOOK_ID', nargs=-1)
         @self.auto_login_user(with_account=True)
-        def fn(account, book_ids, file_type, dest, yes):
+        def fn(account, book_ids, file_type, dest, yes, jobs):
             """Download book(s) by ID*s(."""
-            for book_id in book_ids:
-                book = self.get_book(book_id)
-                if book:
-                    self._download_book(account, book, dest, yes, file_type)
+            file_type = file_type if file_type else account.file_type.value
+            books = self.get_books(book_ids)
+            # Fetch the file data for all books up front
+            books_file_data = self._get_books_file_data(
+                account, books, file_type, jobs)
+            # Confirm and collect the files to download for each book
+            downloads = []
+            for book, book_file_data in zip(books, books_file_data):
+                downloads.extend(self._get_book_downloads(
+                    account, book, book_file_data, dest, yes, file_type))
+            # Download the files for all books concurrently
+            if downloads:
+                self._download_files(account, downloads, jobs)
+                click.echo('')
         return fn
 
     @property
@@ -409,10 +553,10 @@ class BooksContent(DownpourContent):
             """Show book details by ID."""
             book = self.get_book(book_id)
             if book:
-                form = u'{0:>15}: {1}'
+                form = '{0:>15}: {1}'
                 book_data = '\n'.join([
                     form.format('Title', book.title),
-                    form.format('Author(s)', ', '.join(book.author.split('|'))),
+                    form.format('Author(s)', book.author.replace('|', ', ')),
                     form.format('Runtime', f'{book.runtime} hours'),
                     form.format('Purchase Date', book.purchase_date.strftime('%d %B %Y')),
                     form.format('Released', 'Yes' if book.is_released else 'No'),
@@ -16,21 +16,28 @@ along with this program.  If not, see [https://www.gnu.org/licenses/].
 """
 
 import os
+import re
+import sys
 import enum
 import time
 
 import click
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from requests import Session, RequestException
-
-from yaspin import yaspin
-from yaspin.spinners import Spinners
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from sqlalchemy_utils import EmailType
 from sqlalchemy.dialects.sqlite import BLOB
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy import Table, Column, String, DateTime, PickleType, Enum, func
 
+# Only parse the parts of Downpour pages needed to log in
+_LOGIN_FORM = SoupStrainer('form', id='login-form')
+_LINKS = SoupStrainer('a')
+# Signout link shown once the login succeeds
+_SIGNOUT_RE = re.compile(rb'>\s*Signout\s*<')
+
 
 class BookFileType(enum.Enum):
     """Valid file types for downloading from Downpour."""
@@ -45,16 +52,27 @@ class DownpourContent:
     # URLs for making requests
     base_url = 'https://www.downpour.com'
     library_url = f'{base_url}/my-library'
+    login_url = f'{base_url}/customer/account/login/'
     cart_url = f'{base_url}/blackstone_custom/ajax/getCartCount'
     # Common headers for HTTP requests
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:89.0) '
                       'Gecko/20100101 Firefox/89.0'
     }
+    # Cookies that hold the site session ID
+    session_cookie_names = ('PHPSESSID', 'frontend')
+    # Maximum number of pooled connections per host
+    pool_maxsize = 16
+    # Retry transient server errors with exponential backoff
+    retries = Retry(total=3, backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'POST']),
+                    raise_on_status=False)
     # Common parser for BS4
-    parser = 'html.parser'
+    parser = 'lxml'
     # Valid book filetypes
     file_types = BookFileType
+    file_type_values = tuple(b.value for b in BookFileType)
     # Default download path
     download_dir = os.path.join(os.path.expanduser('~'), 'Audiobooks')
     # Set CLI details for account management
@@ -66,12 +84,20 @@ class DownpourContent:
         self.manager = manager
         self.db = self.manager.get_session()
         self.model = self.manager.models.get(self.model_name)
+        self._http = None
 
     def auto_login_user(self, with_account=False):
         """Decorator to automatically log user in for CLI actions."""
         def inner(fn):
             def wrapper(*args, **kwargs):
-                with yaspin(spinner=Spinners.line):
+                # Only show the spinner when writing to a terminal
+                if sys.stdout.isatty():
+                    # Deferred so non-interactive runs skip loading yaspin
+                    from yaspin import yaspin
+                    from yaspin.spinners import Spinners
+                    with yaspin(spinner=Spinners.line):
+                        account = self.login_user()
+                else:
                     account = self.login_user()
                 if not account:
                     return
@@ -82,13 +108,18 @@ class DownpourContent:
         return inner
 
     def session(self, session_cookies):
-        """Create a new API session with the correct cookies and headers."""
-        session = Session()
-        # Add cookies and headers to session
-        session.cookies.update(session_cookies)
-        session.headers = self.headers
-        # Return new session object
-        return session
+        """Get the pooled API session with the correct cookies and headers."""
+        if self._http is None:
+            self._http = Session()
+            self._http.headers = self.headers
+            # Keep connections alive between requests
+            adapter = HTTPAdapter(pool_maxsize=self.pool_maxsize,
+                                  max_retries=self.retries)
+            self._http.mount('https://', adapter)
+        # Add cookies to session
+        self._http.cookies.update(session_cookies)
+        # Return shared session object
+        return self._http
 
     def _get_account(self):
         """Locate an account in the database."""
@@ -119,6 +150,13 @@ class DownpourContent:
 
     def _check_session(self, account):
         """Check if the user's session ID is still valid."""
+        # Skip the network check if the session cookie has already expired
+        now = time.time()
+        if any(cookie.name in self.session_cookie_names
+               and cookie.expires and cookie.expires < now
+               for cookie in account.session or ()):
+            return False
+
         res = self.session(account.session).get(self.cart_url)
         try:
             res.raise_for_status()
@@ -154,13 +192,27 @@ class DownpourContent:
         # Return the logged in account
         return account
 
-    def _make_login_request(self, email, password):
-        """Make a login request with the given credentials"""
-        session = Session()
+    def _parse(self, res, strainer):
+        """Parse part of a response without re-detecting its encoding."""
+        return BeautifulSoup(res.content, self.parser,
+                             from_encoding=res.encoding or 'utf-8',
+                             parse_only=strainer)
+
+    def _find_login_form(self, session, url):
+        """Load a page and look for the login form on it."""
+        page = session.get(url)
+        page_soup = self._parse(page, _LOGIN_FORM)
+        return page_soup.find('form', id='login-form')
 
-        # Load the home page
-        home = session.get(self.base_url, headers=self.headers)
-        home_soup = BeautifulSoup(home.text, self.parser)
+    def _get_login_form(self, session):
+        """Locate the login form, going straight to the login page first."""
+        login_form = self._find_login_form(session, self.login_url)
+        if login_form:
+            return login_form
+
+        # Fall back to following the sign in link from the home page
+        home = session.get(self.base_url)
+        home_soup = self._parse(home, _LINKS)
 
         # Look for login URL
         login_link = home_soup.find('a', string='Sign In')
@@ -169,13 +221,20 @@ class DownpourContent:
             return None
 
         # Navigate to login page
-        post = session.get(login_link['href'], headers=self.headers)
-        post_soup = BeautifulSoup(post.text, 'html.parser')
+        login_form = self._find_login_form(session, login_link['href'])
+        if not login_form:
+            self.manager.error('Unable to login: cannot find login form')
+        return login_form
+
+    def _make_login_request(self, email, password):
+        """Make a login request with the given credentials"""
+        session = self.session({})
+        # Start from a clean cookie jar on the pooled connection
+        session.cookies.clear()
 
         # Look for post URL
-        login_form = post_soup.find('form', id='login-form')
+        login_form = self._get_login_form(session)
         if not login_form:
-            self.manager.error('Unable to login: cannot find login form')
             return None
 
         # Look for form key
@@ -188,7 +247,6 @@ class DownpourContent:
         try:
             login = session.post(
                 login_form['action'],
-                headers=self.headers,
                 data={
                     'form_key': form_key_input['value'],
                     'login[username]': email,
@@ -197,13 +255,12 @@ class DownpourContent:
                 }
             )
             login.raise_for_status()
-            login_soup = BeautifulSoup(login.text, self.parser)
         except RequestException as ex:
             self.manager.error(f'Unable to login: {str(ex)}')
             return None
 
         # Check for success
-        if not login_soup.find('a', string='Signout'):
+        if not _SIGNOUT_RE.search(login.content):
             self.manager.error('Unable to login: invalid login or password')
             return None
 
@@ -234,9 +291,8 @@ class DownpourContent:
         @click.password_option('-p', '--password')
         def fn(email, password):
             """Login with your Downpour credentials."""
-            account = self.db.query(self.model) \
-                .filter_by(email=email) \
-                .first()
+            # Email is the primary key, so this can use the identity map
+            account = self.db.query(self.model).get(email)
             # Add account if it is not found
             if not account:
                 # Attempt to login
@@ -269,7 +325,7 @@ class DownpourContent:
         @click.command(help='Update account information.',
                        no_args_is_help=True)
         @click.option('--file_type', help='Set book file type to download.',
-                      type=click.Choice([b.value for b in BookFileType]))
+                      type=click.Choice(self.file_type_values))
         @click.option('--folder_template', type=click.STRING,
                       help='Set template for folder structure when downloading '
                            'books. Available variables: author, title, book_id')
@@ -305,7 +361,7 @@ class DownpourContent:
         @self.auto_login_user(with_account=True)
         def fn(account):
             """Display account information."""
-            form = u'{0:>15}: {1}'
+            form = '{0:>15}: {1}'
             account_data = '\n'.join([
                 form.format('Email', account.email),
                 form.format('Password', '*********** [hidden for security]'),
@@ -22,7 +22,7 @@ import click
 from cryptography.fernet import Fernet
 
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import MetaData, create_engine
+from sqlalchemy import MetaData, create_engine, inspect
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.ext.automap import automap_base
 
@@ -62,8 +62,9 @@ class DownpourDownloader:
         # Configure the auto-mapping base model
         self._base = automap_base(metadata=self._metadata)
         self._base.prepare()
-        # Setup a session generator for database connections
-        self._session = sessionmaker(bind=self._engine)
+        # Setup a session generator for database connections, keeping loaded
+        # attributes after commits so they aren't re-queried
+        self._session = sessionmaker(bind=self._engine, expire_on_commit=False)
 
     def _setup(self):
         """Make sure files and folders exist."""
@@ -78,7 +79,9 @@ class DownpourDownloader:
 
     def __get_cipher(self):
         """Create a cipher manager from the stored key."""
-        return Fernet(open(self.__key_file, 'rb').read())
+        with open(self.__key_file, 'rb') as f:
+            key = f.read()
+        return Fernet(key)
 
     def encode(self, data):
         """Encode data with the cipher manager."""
@@ -95,10 +98,20 @@ class DownpourDownloader:
                 type_.table(self._metadata)
             except InvalidRequestError:
                 pass
-        # Reflect metadata so auto-mapping works
-        self._metadata.reflect(self._engine)
-        # Make sure the tables exist
-        self._metadata.create_all()
+        # Share one connection and transaction for the schema setup
+        with self._engine.begin() as conn:
+            # Reflect metadata so auto-mapping works
+            self._metadata.reflect(bind=conn)
+            # Make sure the tables exist
+            self._metadata.create_all(bind=conn)
+            # Add any indexes missing from tables created by older versions
+            inspector = inspect(conn)
+            for table in self._metadata.tables.values():
+                existing = {index['name']
+                            for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name not in existing:
+                        index.create(conn)
 
     def get_session(self):
         """Create a new database session using the session maker."""
@@ -126,8 +139,8 @@ class DownpourDownloader:
 
     @staticmethod
     def error(msg):
-        """Print error message in red text."""
-        click.secho(f'[ERROR] {msg}', fg='red')
+        """Print error message in red text to stderr."""
+        click.secho(f'[ERROR] {msg}', fg='red', err=True)
 
     @property
     def cli(self):
@@ -37,12 +37,14 @@ setup(
         'click',
         'beautifulsoup4',
         'cryptography',
+        'lxml',
         'python-dateutil',
         'requests',
         'SQLAlchemy',
         'SQLAlchemy-Utils',
         'tabulate',
         'tqdm',
+        'urllib3>=1.26',
         'yaspin'
     ],
 )